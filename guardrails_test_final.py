@@ -1,77 +1,119 @@
 import anthropic
 from anthropic.types import TextBlock
 
-import json
+import orjson
 import argparse
+import codecs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import html2text
+from concurrent.futures import ThreadPoolExecutor
 from rich.console import Console
 from rich.markdown import Markdown
+
+import llm_cache
 # from guardrails import Guard
 # from guardrails.hub import CompetitorCheck
 # import nltk
 
+anthropic_client = None
+
+def get_anthropic_client():
+    # Share one client (and its HTTP connection pool) between API calls
+    global anthropic_client
+    if anthropic_client is None:
+        anthropic_client = anthropic.Anthropic(
+            # defaults to os.environ.get("ANTHROPIC_API_KEY")
+        )
+    return anthropic_client
+
+# Reuse pooled keep-alive connections for every page fetch
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+# Stop reading a page after this many bytes, so huge pages cannot exhaust memory
+MAX_PAGE_BYTES = 5_000_000
+
 def url_to_markdown(url):
     try:
-        # Send a HTTP request to the URL
-        response = requests.get(url)
-
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Convert the HTML content to Markdown
-            html_converter = html2text.HTML2Text()
-
-            # Optional: Configure the converter
-            html_converter.ignore_links = False
-            html_converter.ignore_images = False
-            html_converter.ignore_emphasis = False
-
-            # Convert HTML to Markdown
-            markdown = html_converter.handle(response.text)
-
-            return markdown
-        else:
-            # If the response was not successful, return an error message
-            return f"Error: Received a {response.status_code} status code from the URL."
-    except requests.exceptions.RequestException as e:
+        # Send a HTTP request to the URL, streaming the body instead of buffering it
+        with http_session.get(url, timeout=(5, 30), stream=True) as response:
+
+            # Check if the request was successful
+            if response.status_code == 200:
+                # Convert the HTML content to Markdown
+                html_converter = html2text.HTML2Text()
+
+                # Optional: Configure the converter
+                html_converter.ignore_links = False
+                html_converter.ignore_images = False
+                html_converter.ignore_emphasis = False
+                # Skip the line re-wrapping pass, the text is read by a model, not a terminal
+                html_converter.body_width = 0
+
+                # Feed the HTML to the converter while it downloads, up to MAX_PAGE_BYTES
+                decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+                received = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    html_converter.feed(decoder.decode(chunk))
+                    received += len(chunk)
+                    if received >= MAX_PAGE_BYTES:
+                        break
+
+                # Convert HTML to Markdown
+                markdown = html_converter.handle(decoder.decode(b"", final=True))
+
+                return markdown
+            else:
+                # If the response was not successful, return an error message
+                return f"Error: Received a {response.status_code} status code from the URL."
+    except (requests.exceptions.RequestException, LookupError) as e:
         return f"Error: {e}"
 
+# The extraction instructions are the same for every page
+EXTRACTION_SYSTEM_PROMPT = "You're an expert in web scraping and data extraction, known for your meticulous attention to detail and your proficiency in extracting complete structured data from unstructured sources. Use the chain of thought method with the following steps:\n\n" \
+    "1. Read the given document and split it into chapters using headings and subheadings.\n" \
+    "2. For each chapter, translate it to English, extract list format data, and convert it to a table.\n" \
+    "3. Extract any images from the documentation and provide complete image URLs within the chapters.\n" \
+    "4. If there are no tables or images, omit the 'table' or 'image' fields from the returned data. Do not provide empty or null values, and do not fabricate URLs.\n" \
+    "5. Translate all data to English and return it in structured JSON format as follows:\n\n" \
+    "{\n" \
+    "  'topic': 'summary line of the whole text in English',\n" \
+    "  'summary': 'short summary of the whole text in English',\n" \
+    "  'language': 'original language of the whole text',\n" \
+    "  'page_category': ['article', 'collection', 'category', 'product', 'news', 'service', 'other', 'faq', 'home'],\n" \
+    "  'product': {'name': 'product title', 'price': 'product price', 'currency': 'product currency', 'description': 'product description'},\n" \
+    "  'service': {'name': 'service name', 'price': 'service price', 'description': 'service description'},\n" \
+    "  'chapters': [\n" \
+    "    {\n" \
+    "      'topic': 'topic of the chapter in English',\n" \
+    "      'question': 'a question that this chapter answers in English',\n" \
+    "      'keywords': ['max 3 keywords for the chapter'],\n" \
+    "      'image': {'image_url': 'absolute, complete image URL, fix if incomplete', 'image_alt': 'image alt text', 'image_title': 'image title'},  // Omit if no image\n" \
+    "      'table': {'table_name': 'table name', 'headers': ['header1', 'header2'], 'rows': [['row1col1', 'row1col2'], ['row2col1', 'row2col2']]},  // Omit if no table\n" \
+    "      'content': 'chapter contents 150-500 words in English'\n" \
+    "    }\n" \
+    "  ]\n" \
+    "}\n\n" \
+    "Note: It is crucial not to lose any data or details. Ensure all data and complete tables are returned.\n" \
+    "Ensure the returned data is in English. Only return plain, valid JSON, no numbered lists, no with no additional text.\n"
+
 def query_chunks(markdown_content):
-    client = anthropic.Anthropic(
-        # defaults to os.environ.get("ANTHROPIC_API_KEY")
-        #api_key="my_api_key",
-    )
+    client = get_anthropic_client()
 
-    message = client.messages.create(
+    message = llm_cache.create_message(
+        client,
         model="claude-3-haiku-20240307",
         max_tokens=4000,
         temperature=0,
-        system="You're an expert in web scraping and data extraction, known for your meticulous attention to detail and your proficiency in extracting complete structured data from unstructured sources. Use the chain of thought method with the following steps:\n\n" \
-               "1. Read the given document and split it into chapters using headings and subheadings.\n" \
-               "2. For each chapter, translate it to English, extract list format data, and convert it to a table.\n" \
-               "3. Extract any images from the documentation and provide complete image URLs within the chapters.\n" \
-               "4. If there are no tables or images, omit the 'table' or 'image' fields from the returned data. Do not provide empty or null values, and do not fabricate URLs.\n" \
-               "5. Translate all data to English and return it in structured JSON format as follows:\n\n" \
-               "{\n" \
-               "  'topic': 'summary line of the whole text in English',\n" \
-               "  'summary': 'short summary of the whole text in English',\n" \
-               "  'language': 'original language of the whole text',\n" \
-               "  'page_category': ['article', 'collection', 'category', 'product', 'news', 'service', 'other', 'faq', 'home'],\n" \
-               "  'product': {'name': 'product title', 'price': 'product price', 'currency': 'product currency', 'description': 'product description'},\n" \
-               "  'service': {'name': 'service name', 'price': 'service price', 'description': 'service description'},\n" \
-               "  'chapters': [\n" \
-               "    {\n" \
-               "      'topic': 'topic of the chapter in English',\n" \
-               "      'question': 'a question that this chapter answers in English',\n" \
-               "      'keywords': ['max 3 keywords for the chapter'],\n" \
-               "      'image': {'image_url': 'absolute, complete image URL, fix if incomplete', 'image_alt': 'image alt text', 'image_title': 'image title'},  // Omit if no image\n" \
-               "      'table': {'table_name': 'table name', 'headers': ['header1', 'header2'], 'rows': [['row1col1', 'row1col2'], ['row2col1', 'row2col2']]},  // Omit if no table\n" \
-               "      'content': 'chapter contents 150-500 words in English'\n" \
-               "    }\n" \
-               "  ]\n" \
-               "}\n\n" \
-               "Note: It is crucial not to lose any data or details. Ensure all data and complete tables are returned.\n" \
-               "Ensure the returned data is in English. Only return plain, valid JSON, no numbered lists, no with no additional text.\n",
+        system=EXTRACTION_SYSTEM_PROMPT,
         messages=[
             {
                 "role": "user",
@@ -103,14 +145,14 @@ def query_chunks(markdown_content):
     if final_response:
         try:
             # Attempt to load the JSON response
-            json_response = json.loads(final_response)
-        except json.JSONDecodeError:
+            json_response = orjson.loads(final_response)
+        except orjson.JSONDecodeError:
             # Handle faulty JSON by attempting to correct common issues
             # such as unescaped quotes or missing brackets
             corrected_json = final_response.replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
             try:
-                json_response = json.loads(corrected_json)
-            except json.JSONDecodeError:
+                json_response = orjson.loads(corrected_json)
+            except orjson.JSONDecodeError:
                 # If JSON is still faulty, log an error and return None
                 print("Failed to decode JSON response. Raw response:")
                 print(final_response)
@@ -120,21 +162,42 @@ def query_chunks(markdown_content):
 
     return json_response
 
-def query_rag(content_chunks, question, guardrails_results):
-    client = anthropic.Anthropic(
-        # defaults to os.environ.get("ANTHROPIC_API_KEY")
-    )
+# Chapter fields the answering model needs, the keywords and sample questions only add prompt tokens
+RAG_CHAPTER_FIELDS = ("topic", "content", "table", "image")
+
+def slim_chapters(chapters):
+    return [
+        {field: chapter[field] for field in RAG_CHAPTER_FIELDS if field in chapter}
+        for chapter in chapters
+    ]
+
+def query_rag(content_chunks, question, guardrails_results, on_text):
+    client = get_anthropic_client()
     # Convert the list of content chunks to a JSON string
-    content_chunks_json = json.dumps(content_chunks)
+    content_chunks_json = orjson.dumps(slim_chapters(content_chunks)).decode()
     system_prompt = "You're a helpful assistant. Please respond to the user's query using the following documents: \n\n" \
-               "<documents>" + content_chunks_json + "</documents>\n\n" \
-               "Please consider following guardrails report <guardrails>" + guardrails_results + "</guardrails>\n\n" \
+               "<documents>" + content_chunks_json + "</documents>\n\n"
+    # The guardrails report changes with every question, so it goes after the cached documents
+    guardrails_prompt = "Please consider following guardrails report <guardrails>" + guardrails_results + "</guardrails>\n\n"
 
-    message = client.messages.create(
+    message = llm_cache.stream_message(
+        client,
+        on_text,
         model="claude-3-haiku-20240307",
         max_tokens=4000,
         temperature=0,
-        system=system_prompt,
+        system=[
+            {
+                "type": "text",
+                "text": system_prompt,
+                # The documents stay the same for every question about the page, so let the API cache them
+                "cache_control": {"type": "ephemeral"}
+            },
+            {
+                "type": "text",
+                "text": guardrails_prompt
+            }
+        ],
         messages=[
             {
                 "role": "user",
@@ -155,9 +218,7 @@ def query_rag(content_chunks, question, guardrails_results):
     return final_response
 
 def run_guardrails(user_query):
-    client = anthropic.Anthropic(
-        # defaults to os.environ.get("ANTHROPIC_API_KEY")
-    )
+    client = get_anthropic_client()
     prompt = (
         "Consider the content within <message>" + user_query + "</message> as user input. "
         "Respond in JSON format, translating the user message into English in 'message_en', and set the following fields as true/false based on your analysis: "
@@ -197,9 +258,11 @@ def run_guardrails(user_query):
 
     system_prompt = "As a content moderator and auditor specialized in overseeing interactions with Large Language Models, your role is to analyze user messages for potential misuse."
 
-    message = client.messages.create(
+    message = llm_cache.create_message(
+        client,
         model="claude-3-haiku-20240307",
-        max_tokens=4000,
+        # The report is a short JSON object, a small budget caps runaway replies
+        max_tokens=1024,
         temperature=0,
         system=system_prompt,
         messages=[
@@ -231,6 +294,10 @@ def run_guardrails(user_query):
 
     return final_response
 
+def print_text(text):
+    # Print streamed text as soon as it arrives
+    print(text, end="", flush=True)
+
 def main():
     # Create an argument parser
     parser = argparse.ArgumentParser(description="Convert HTML from a URL to Markdown.")
@@ -241,29 +308,36 @@ def main():
     # Parse command-line arguments
     args = parser.parse_args()
 
-    # Convert URL to Markdown
-    markdown_content = url_to_markdown(args.url)
+    # Create the shared client before it is used from two threads
+    get_anthropic_client()
 
-    # Query Anthropics API
-    json_response = query_chunks(markdown_content)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The guardrails check only needs the question, so run it while the page is processed
+        guardrails_future = executor.submit(run_guardrails, args.question)
 
-    validated_results = run_guardrails(args.question)
+        # Convert URL to Markdown
+        markdown_content = url_to_markdown(args.url)
 
-    if json_response and 'chapters' in json_response:
-        rag_response = query_rag(json_response['chapters'], args.question, validated_results)
-    else:
+        # Query Anthropics API
+        json_response = query_chunks(markdown_content)
+
+        validated_results = guardrails_future.result()
+
+    if not (json_response and 'chapters' in json_response):
         print("Error: Invalid JSON response or missing 'chapters' key")
         return
 
     if args.output:
-        # If an output file is specified, write the markdown content to the file
+        # If an output file is specified, write the answer to the file while it is generated
         with open(args.output, 'w', encoding='utf-8') as file:
-            file.write(rag_response)
+            query_rag(json_response['chapters'], args.question, validated_results, file.write)
             print(f"Markdown content has been saved to {args.output}")
     else:
-        # Otherwise, print the markdown content to the standard output
-        print(rag_response)
+        # Otherwise, print the answer to the standard output while it is generated
+        query_rag(json_response['chapters'], args.question, validated_results, print_text)
+        print()
         print(validated_results)
 
 if __name__ == "__main__":
     main()
+    llm_cache.report()
@@ -1,80 +1,132 @@
 import anthropic
 from anthropic.types import TextBlock
 
-import json
+import orjson
 import argparse
+import codecs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import html2text
 import ollama
 import chromadb
-import uuid
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 from rich.console import Console
 from rich.markdown import Markdown
 
+import llm_cache
+
+anthropic_client = None
+
+def get_anthropic_client():
+    # Share one client (and its HTTP connection pool) between API calls
+    global anthropic_client
+    if anthropic_client is None:
+        anthropic_client = anthropic.Anthropic(
+            # defaults to os.environ.get("ANTHROPIC_API_KEY")
+        )
+    return anthropic_client
+
+# Reuse pooled keep-alive connections for every page fetch
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+# Stop reading a page after this many bytes, so huge pages cannot exhaust memory
+MAX_PAGE_BYTES = 5_000_000
+
 def url_to_markdown(url):
     try:
-        # Send a HTTP request to the URL
-        response = requests.get(url)
+        # Send a HTTP request to the URL, streaming the body instead of buffering it
+        with http_session.get(url, timeout=(5, 30), stream=True) as response:
 
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Convert the HTML content to Markdown
-            html_converter = html2text.HTML2Text()
+            # Check if the request was successful
+            if response.status_code == 200:
+                # Convert the HTML content to Markdown
+                html_converter = html2text.HTML2Text()
 
-            # Optional: Configure the converter
-            html_converter.ignore_links = False
-            html_converter.ignore_images = True
-            html_converter.ignore_emphasis = False
+                # Optional: Configure the converter
+                html_converter.ignore_links = False
+                html_converter.ignore_images = True
+                html_converter.ignore_emphasis = False
+                # Skip the line re-wrapping pass, the text is read by a model, not a terminal
+                html_converter.body_width = 0
 
-            # Convert HTML to Markdown
-            markdown = html_converter.handle(response.text)
+                # Feed the HTML to the converter while it downloads, up to MAX_PAGE_BYTES
+                decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+                received = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    html_converter.feed(decoder.decode(chunk))
+                    received += len(chunk)
+                    if received >= MAX_PAGE_BYTES:
+                        break
 
-            return markdown
-        else:
-            # If the response was not successful, return an error message
-            return f"Error: Received a {response.status_code} status code from the URL."
-    except requests.exceptions.RequestException as e:
-        return f"Error: {e}"
+                # Convert HTML to Markdown
+                markdown = html_converter.handle(decoder.decode(b"", final=True))
+
+                return markdown
+            else:
+                # If the response was not successful, report it and return None so the page is not indexed
+                print(f"Error: Received a {response.status_code} status code from {url}.")
+                return None
+    except (requests.exceptions.RequestException, LookupError) as e:
+        print(f"Error: Could not fetch {url}: {e}")
+        return None
+
+def urls_to_markdown(urls):
+    if not urls:
+        return []
+
+    # Fetch the pages concurrently, as each download mostly waits on the network
+    with ThreadPoolExecutor(max_workers=min(len(urls), 8)) as executor:
+        return list(executor.map(url_to_markdown, urls))
+
+# The extraction instructions are the same for every page
+EXTRACTION_SYSTEM_PROMPT = "You're an expert in web scraping and data extraction, known for your meticulous attention to detail and your proficiency in extracting complete structured data from unstructured sources. Use the chain of thought method with the following steps:\n\n" \
+    "1. Read the given document and split it into chapters using headings and subheadings.\n" \
+    "2. For each chapter, translate it to English, extract list format data, and convert it to a table.\n" \
+    "3. Extract any images from the documentation and provide complete image URLs within the chapters.\n" \
+    "4. If there are no tables or images, omit the 'table' or 'image' fields from the returned data. Do not provide empty or null values, and do not fabricate URLs.\n" \
+    "5. Avoid using double quotes (\") in JSON response value, use them only in key-value pairs. Instead, use single quotes (') for any quoted text within value fields to prevent conflicts with JSON syntax." \
+    "6. If a value absolutely requires double quotes, use a JSON-safe encoding method like escaping or an alternative representation." \
+    "7. Translate all data to English and return it in structured JSON format as follows:\n\n" \
+    "{\n" \
+    "  'topic': 'summary line of the whole text in English',\n" \
+    "  'summary': 'short summary of the whole text in English',\n" \
+    "  'language': 'original language of the whole text',\n" \
+    "  'page_category': ['article', 'collection', 'category', 'product', 'news', 'service', 'other', 'faq', 'home'],\n" \
+    "  'product': {'name': 'product title', 'price': 'product price', 'currency': 'product currency', 'description': 'product description'},\n" \
+    "  'service': {'name': 'service name', 'price': 'service price', 'description': 'service description'},\n" \
+    "  'chapters': [\n" \
+    "    {\n" \
+    "      'topic': 'topic of the chapter in English',\n" \
+    "      'question': 'a question that this chapter answers in English',\n" \
+    "      'keywords': ['max 3 keywords for the chapter'],\n" \
+    "      'image': {'image_url': 'absolute, complete image URL, fix if incomplete', 'image_alt': 'image alt text', 'image_title': 'image title'},  // Omit if no image\n" \
+    "      'table': {'table_name': 'table name', 'headers': ['header1', 'header2'], 'rows': [['row1col1', 'row1col2'], ['row2col1', 'row2col2']]},  // Omit if no table\n" \
+    "      'content': 'chapter contents 150-500 words in English'\n" \
+    "    }\n" \
+    "  ]\n" \
+    "}\n\n" \
+    "Note: It is crucial not to lose any data or details. Ensure all data and complete tables are returned.\n" \
+    "Ensure the returned data is in English. Only return plain, valid JSON, no numbered lists, with no additional text.\n"
 
 def query_chunks(markdown_content):
-    client = anthropic.Anthropic(
-        # defaults to os.environ.get("ANTHROPIC_API_KEY")
-        #api_key="my_api_key",
-    )
+    client = get_anthropic_client()
 
-    message = client.messages.create(
+    message = llm_cache.create_message(
+        client,
         model="claude-3-haiku-20240307",
         max_tokens=4000,
         temperature=0,
-       system="You're an expert in web scraping and data extraction, known for your meticulous attention to detail and your proficiency in extracting complete structured data from unstructured sources. Use the chain of thought method with the following steps:\n\n" \
-               "1. Read the given document and split it into chapters using headings and subheadings.\n" \
-               "2. For each chapter, translate it to English, extract list format data, and convert it to a table.\n" \
-               "3. Extract any images from the documentation and provide complete image URLs within the chapters.\n" \
-               "4. If there are no tables or images, omit the 'table' or 'image' fields from the returned data. Do not provide empty or null values, and do not fabricate URLs.\n" \
-               "5. Avoid using double quotes (\") in JSON response value, use them only in key-value pairs. Instead, use single quotes (') for any quoted text within value fields to prevent conflicts with JSON syntax." \
-               "6. If a value absolutely requires double quotes, use a JSON-safe encoding method like escaping or an alternative representation." \
-               "7. Translate all data to English and return it in structured JSON format as follows:\n\n" \
-               "{\n" \
-               "  'topic': 'summary line of the whole text in English',\n" \
-               "  'summary': 'short summary of the whole text in English',\n" \
-               "  'language': 'original language of the whole text',\n" \
-               "  'page_category': ['article', 'collection', 'category', 'product', 'news', 'service', 'other', 'faq', 'home'],\n" \
-               "  'product': {'name': 'product title', 'price': 'product price', 'currency': 'product currency', 'description': 'product description'},\n" \
-               "  'service': {'name': 'service name', 'price': 'service price', 'description': 'service description'},\n" \
-               "  'chapters': [\n" \
-               "    {\n" \
-               "      'topic': 'topic of the chapter in English',\n" \
-               "      'question': 'a question that this chapter answers in English',\n" \
-               "      'keywords': ['max 3 keywords for the chapter'],\n" \
-               "      'image': {'image_url': 'absolute, complete image URL, fix if incomplete', 'image_alt': 'image alt text', 'image_title': 'image title'},  // Omit if no image\n" \
-               "      'table': {'table_name': 'table name', 'headers': ['header1', 'header2'], 'rows': [['row1col1', 'row1col2'], ['row2col1', 'row2col2']]},  // Omit if no table\n" \
-               "      'content': 'chapter contents 150-500 words in English'\n" \
-               "    }\n" \
-               "  ]\n" \
-               "}\n\n" \
-               "Note: It is crucial not to lose any data or details. Ensure all data and complete tables are returned.\n" \
-               "Ensure the returned data is in English. Only return plain, valid JSON, no numbered lists, with no additional text.\n",
+        system=EXTRACTION_SYSTEM_PROMPT,
         messages=[
             {
                 "role": "user",
@@ -103,47 +155,155 @@ def query_chunks(markdown_content):
         (block.text for block in message.content if isinstance(block, TextBlock)),
         None,
     )
-    return json.loads('{' + final_response)
+    return orjson.loads('{' + final_response)
+
+# Headings where a page may be split for parallel extraction
+SECTION_HEADING = re.compile(r"^#{1,3} ", re.MULTILINE)
+# Sections are grouped into parts of about this many characters, one extraction call per part
+MAX_PART_CHARS = 12000
+
+def split_markdown(markdown_content):
+    # Split at headings, merging small sections so each part is worth its own call
+    starts = [match.start() for match in SECTION_HEADING.finditer(markdown_content)]
+    boundaries = sorted(set([0] + starts)) + [len(markdown_content)]
+    parts = []
+    current = ""
+    for start, end in zip(boundaries, boundaries[1:]):
+        section = markdown_content[start:end]
+        if current and len(current) + len(section) > MAX_PART_CHARS:
+            parts.append(current)
+            current = ""
+        current += section
+    if current:
+        parts.append(current)
+    return parts
+
+def query_chunks_parallel(markdown_content):
+    parts = split_markdown(markdown_content)
+    if len(parts) <= 1:
+        return query_chunks(markdown_content)
+
+    # Create the shared client before it is used from the worker threads
+    get_anthropic_client()
+
+    # Extract every part concurrently, the calls only wait on the API
+    with ThreadPoolExecutor(max_workers=min(len(parts), 8)) as executor:
+        responses = list(executor.map(query_chunks, parts))
 
-def index_chunks(content_chunks):
+    # Page level fields come from the first part, chapters from all parts in page order
+    json_response = responses[0]
+    json_response['chapters'] = [chapter for response in responses for chapter in response.get('chapters', [])]
+    return json_response
+
+# Reuse one Ollama client (and its HTTP connection pool) for every call
+ollama_client = ollama.Client()
+
+chroma_client = None
+docs_collection = None
+
+def get_docs_collection():
+    # Resolve the collection once, every lookup is an HTTP round-trip to Chroma
+    global chroma_client, docs_collection
+    if docs_collection is None:
+        chroma_client = chromadb.HttpClient(host='localhost', port=8000)
+        docs_collection = chroma_client.get_or_create_collection(
+            "docs",
+            # HNSW index settings, only applied when the collection is first created.
+            # The corpus is small and queries only read the top result, so favour speed over extra recall
+            metadata={"hnsw:space": "cosine", "hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 32}
+        )
+
+        # Collections from older versions hold unnormalized vectors without page URLs, which cannot be matched or replaced
+        if (docs_collection.metadata or {}).get("hnsw:space") != "cosine":
+            raise SystemExit("The docs collection was created by an older version of index_site.py. Delete it and index the pages again, see README.md.")
+    return docs_collection
+
+def is_indexed(url):
+    # Chunks are stored with the URL of their page, so ingested pages can be skipped entirely
+    return bool(get_docs_collection().get(where={"url": url}, limit=1)["ids"])
+
+def chapter_id(url, document):
+    # Content-addressed id, an unchanged chapter of a page always gets the same id
+    return llm_cache.hash_hex((url + "\n" + document).encode("utf-8"))
+
+def index_chunks(content_chunks, url):
 
     # Convert the list of content chunks to a JSON string
-    content_chunks_json = json.dumps(content_chunks)
-
-    client = chromadb.HttpClient(host='localhost', port=8000)
-    collection = client.get_or_create_collection("docs")
-
-    # store each document in a vector embedding database
-    for i, chunk in enumerate(content_chunks):
-        print(chunk)
-        table_content = json.dumps(chunk['table']) if chunk.get('table') is not None else ''
-        response = ollama.embeddings(model="mxbai-embed-large", prompt=table_content + json.dumps(chunk['content']))
-        embedding = response["embedding"]
-        collection.add(
-            ids=[str(uuid.uuid4())],
-            embeddings=[embedding],
-            documents=[json.dumps(chunk)]
+    content_chunks_json = orjson.dumps(content_chunks).decode()
+
+    collection = get_docs_collection()
+
+    # Store chapters as canonical JSON (sorted keys), so equal chapters serialize and hash the same way
+    chapters = {}
+    for chunk in content_chunks:
+        document = orjson.dumps(chunk, option=orjson.OPT_SORT_KEYS).decode()
+        # A chapter repeated on the page is stored only once
+        chapters.setdefault(chapter_id(url, document), (chunk, document))
+
+    if chapters:
+        embedding_inputs = []
+        for chunk, document in chapters.values():
+            print(chunk)
+            table_content = orjson.dumps(chunk['table']).decode() if chunk.get('table') is not None else ''
+            embedding_inputs.append(table_content + orjson.dumps(chunk['content']).decode())
+
+        # embed all chunks of the page in one request instead of one request per chunk
+        response = ollama_client.embed(model="mxbai-embed-large", input=embedding_inputs)
+
+        # store each document in a vector embedding database, before anything of an earlier ingest is removed
+        collection.upsert(
+            ids=list(chapters),
+            embeddings=response["embeddings"],
+            documents=[document for chunk, document in chapters.values()],
+            metadatas=[{"url": url} for chunk, document in chapters.values()]
         )
 
+    # Remove the chunks of an earlier ingest of the same page that are no longer on it
+    stale_ids = [id for id in collection.get(where={"url": url}, include=[])["ids"] if id not in chapters]
+    if stale_ids:
+        collection.delete(ids=stale_ids)
 
     return content_chunks_json
 
 def main():
     # Create an argument parser
     parser = argparse.ArgumentParser(description="Convert HTML from a URL to Markdown.")
-    parser.add_argument("url", type=str, help="URL of the webpage to convert to markdown")
+    parser.add_argument("urls", type=str, nargs='+', help="URLs of the webpages to convert to markdown")
     parser.add_argument("-o", "--output", type=str, help="Output file to save the markdown content")
+    parser.add_argument("-f", "--force", action="store_true", help="Index pages again even if they are already in the database")
 
     # Parse command-line arguments
     args = parser.parse_args()
 
-    # Convert URL to Markdown
-    markdown_content = url_to_markdown(args.url)
+    # Skip pages that are already indexed, unless asked to index them again
+    urls = []
+    for url in args.urls:
+        if not args.force and is_indexed(url):
+            print(f"Skipping {url}, it is already indexed. Use --force to index it again.")
+        else:
+            urls.append(url)
+
+    # Convert URLs to Markdown
+    markdown_contents = urls_to_markdown(urls)
+
+    chunks_responses = []
+    for url, markdown_content in zip(urls, markdown_contents):
+        if markdown_content is None:
+            # Leave failed pages out of the index, so the next run fetches them again
+            print(f"Skipping {url}, it could not be fetched.")
+            continue
+
+        try:
+            # Query Anthropics API
+            json_response = query_chunks_parallel(markdown_content)
 
-    # Query Anthropics API
-    json_response = query_chunks(markdown_content)
+            chunks_responses.append(index_chunks(json_response['chapters'], url))
+        except Exception as e:
+            # One failed page should not lose the pages after it, it is left unindexed and retried on the next run
+            print(f"Skipping {url}, it could not be extracted or indexed: {e}")
 
-    chunks_response = index_chunks(json_response['chapters'])
+    # One JSON list of chunks per line, in the order the URLs were given
+    chunks_response = "\n".join(chunks_responses)
 
     if args.output:
         # If an output file is specified, write the markdown content to the file
@@ -156,3 +316,4 @@ def main():
 
 if __name__ == "__main__":
     main()
+    llm_cache.report()
@@ -0,0 +1,126 @@
+import hashlib
+import orjson
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from anthropic.types import Message, TextBlock
+
+# Responses are stored in a local SQLite file next to where the scripts are run
+CACHE_PATH = os.environ.get("LLM_CACHE_PATH", ".llm_cache.sqlite")
+CACHE_TTL_SECONDS = int(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600))
+CACHE_ENABLED = os.environ.get("LLM_CACHE", "1") != "0"
+
+hits = 0
+misses = 0
+# Calls can come from worker threads (index_site extracts page parts in parallel)
+counter_lock = threading.Lock()
+
+def count(hit):
+    global hits, misses
+    with counter_lock:
+        if hit:
+            hits += 1
+        else:
+            misses += 1
+
+def report():
+    # Printed at the end of each script, so the effect of the cache is visible
+    if CACHE_ENABLED:
+        print(f"LLM cache: {hits} hits, {misses} misses")
+
+def connect():
+    db = sqlite3.connect(CACHE_PATH)
+    db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL, value TEXT)")
+    return db
+
+def hash_hex(data):
+    # Keys only need to be unique, not cryptographically strong, so 16 bytes are plenty.
+    # Always the same algorithm, so cache keys and chapter ids stay stable across machines
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def cache_key(request):
+    # Canonical JSON (sorted keys, no whitespace) so the same request always gives the same key
+    canonical = orjson.dumps(request, option=orjson.OPT_SORT_KEYS)
+    return hash_hex(canonical)
+
+def get_cached(key):
+    with closing(connect()) as db:
+        row = db.execute("SELECT created, value FROM responses WHERE key = ?", (key,)).fetchone()
+    if row is None or time.time() - row[0] > CACHE_TTL_SECONDS:
+        return None
+    return row[1]
+
+def store(key, value):
+    with closing(connect()) as db, db:
+        db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, time.time(), value))
+
+def create_message(client, **kwargs):
+    # Same arguments as client.messages.create, answered from the cache when possible
+
+    # Only deterministic requests can be reused, the API defaults to temperature 1
+    if not CACHE_ENABLED or kwargs.get("temperature", 1) != 0:
+        return client.messages.create(**kwargs)
+
+    key = cache_key(kwargs)
+    cached = get_cached(key)
+    message = Message.model_validate_json(cached) if cached is not None else None
+    # Entries stored before incomplete replies were skipped are treated as misses
+    if message is not None and message.stop_reason == "end_turn":
+        count(True)
+        return message
+
+    count(False)
+    message = client.messages.create(**kwargs)
+    # A reply cut off at max_tokens is incomplete (often broken JSON), do not replay it
+    if message.stop_reason == "end_turn":
+        store(key, message.model_dump_json())
+    return message
+
+def stream_message(client, on_text, **kwargs):
+    # Like create_message, but hands the reply text to on_text while it is generated
+    cacheable = CACHE_ENABLED and kwargs.get("temperature", 1) == 0
+    if cacheable:
+        key = cache_key(kwargs)
+        cached = get_cached(key)
+        message = Message.model_validate_json(cached) if cached is not None else None
+        # Entries stored before incomplete replies were skipped are treated as misses
+        if message is not None and message.stop_reason == "end_turn":
+            count(True)
+            for block in message.content:
+                if isinstance(block, TextBlock):
+                    on_text(block.text)
+            return message
+        count(False)
+
+    with client.messages.stream(**kwargs) as stream:
+        for text in stream.text_stream:
+            on_text(text)
+        message = stream.get_final_message()
+
+    if cacheable and message.stop_reason == "end_turn":
+        store(key, message.model_dump_json())
+    return message
+
+def create_embedding(client, model, prompt):
+    # Embeds one prompt with client.embed, returns the cached embedding vector when possible
+
+    # Extra whitespace does not change the meaning, so equal queries share one cache entry
+    prompt = " ".join(prompt.split())
+
+    if not CACHE_ENABLED:
+        return client.embed(model=model, input=prompt)["embeddings"][0]
+
+    # Embedding models are deterministic, so every repeated prompt can be reused
+    key = cache_key({"embed_model": model, "input": prompt})
+    cached = get_cached(key)
+    if cached is not None:
+        count(True)
+        return orjson.loads(cached)
+
+    count(False)
+    embedding = client.embed(model=model, input=prompt)["embeddings"][0]
+    store(key, orjson.dumps(embedding).decode())
+    return embedding
@@ -1,9 +1,11 @@
 import anthropic
 from anthropic.types import TextBlock
 
-import json
 import argparse
+import codecs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import html2text
 import ollama
 import chromadb
@@ -11,84 +13,129 @@ import chromadb
 from rich.console import Console
 from rich.markdown import Markdown
 
+import llm_cache
+
+# Reuse pooled keep-alive connections for every page fetch
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+# Stop reading a page after this many bytes, so huge pages cannot exhaust memory
+MAX_PAGE_BYTES = 5_000_000
+
 def url_to_markdown(url):
     try:
-        # Send a HTTP request to the URL
-        response = requests.get(url)
-
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Convert the HTML content to Markdown
-            html_converter = html2text.HTML2Text()
-
-            # Optional: Configure the converter
-            html_converter.ignore_links = False
-            html_converter.ignore_images = True
-            html_converter.ignore_emphasis = False
-
-            # Convert HTML to Markdown
-            markdown = html_converter.handle(response.text)
-
-            return markdown
-        else:
-            # If the response was not successful, return an error message
-            return f"Error: Received a {response.status_code} status code from the URL."
-    except requests.exceptions.RequestException as e:
+        # Send a HTTP request to the URL, streaming the body instead of buffering it
+        with http_session.get(url, timeout=(5, 30), stream=True) as response:
+
+            # Check if the request was successful
+            if response.status_code == 200:
+                # Convert the HTML content to Markdown
+                html_converter = html2text.HTML2Text()
+
+                # Optional: Configure the converter
+                html_converter.ignore_links = False
+                html_converter.ignore_images = True
+                html_converter.ignore_emphasis = False
+                # Skip the line re-wrapping pass, the text is read by a model, not a terminal
+                html_converter.body_width = 0
+
+                # Feed the HTML to the converter while it downloads, up to MAX_PAGE_BYTES
+                decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+                received = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    html_converter.feed(decoder.decode(chunk))
+                    received += len(chunk)
+                    if received >= MAX_PAGE_BYTES:
+                        break
+
+                # Convert HTML to Markdown
+                markdown = html_converter.handle(decoder.decode(b"", final=True))
+
+                return markdown
+            else:
+                # If the response was not successful, return an error message
+                return f"Error: Received a {response.status_code} status code from the URL."
+    except (requests.exceptions.RequestException, LookupError) as e:
         return f"Error: {e}"
 
+# Reuse one Ollama client (and its HTTP connection pool) for every call
+ollama_client = ollama.Client()
+
+chroma_client = None
+docs_collection = None
+
+def get_docs_collection():
+    # Resolve the collection once, every lookup is an HTTP round-trip to Chroma
+    global chroma_client, docs_collection
+    if docs_collection is None:
+        chroma_client = chromadb.HttpClient(host='localhost', port=8000)
+        docs_collection = chroma_client.get_collection("docs")
+
+        # Collections from older versions hold unnormalized vectors without page URLs, which cannot be matched or replaced
+        if (docs_collection.metadata or {}).get("hnsw:space") != "cosine":
+            raise SystemExit("The docs collection was created by an older version of index_site.py. Delete it and index the pages again, see README.md.")
+    return docs_collection
+
 def query_chunks(query):
-    client = chromadb.HttpClient(host='localhost', port=8000)
-    collection = client.get_collection("docs")
-   # generate an embedding for the prompt and retrieve the most relevant doc
-    response = ollama.embeddings(
-        prompt=query,
-        model="mxbai-embed-large"
-    )
+    collection = get_docs_collection()
+   # generate an embedding for the prompt (reused from the cache for repeated questions) and retrieve the most relevant doc
+    embedding = llm_cache.create_embedding(ollama_client, model="mxbai-embed-large", prompt=query)
     results = collection.query(
-        query_embeddings=[response["embedding"]],
-        n_results=1
+        query_embeddings=[embedding],
+        n_results=1,
+        # Only the document text is used, skip returning metadata and distances
+        include=["documents"]
     )
     print(results)
     data = results['documents'][0][0]
     return data
 
-def query_rag(content_chunks, question):
-    client = anthropic.Anthropic(
-        # defaults to os.environ.get("ANTHROPIC_API_KEY")
-    )
-    # Convert the list of content chunks to a JSON string
-    content_chunks_json = json.dumps(content_chunks)
+def query_rag(content_chunks, question, on_text):
+    # The document from Chroma is already a JSON string, so it goes into the prompt as is
     system_prompt = "You're a helpful assistant. Please respond to the user's query in user's own language using the following documents: \n\n" \
-               "<documents>" + content_chunks_json + "</documents>" \
+               "<documents>" + content_chunks + "</documents>" \
                "Respond using the following chain of thought steps:\n" \
                "1. If the documents don't contain the answer, return a web search query with in json with key 'search' \n" \
                "2. Otherwise, respond with professional tone of voice \n" \
                "3. Respond with json format with no other text\n"
 
     print(system_prompt)
-# Serialize the content to a JSON string
-    content_json = json.dumps({
-        "type": "text",
-        "text": system_prompt + "\nQuestion is: " + question
-    })
 
-    message = ollama.chat(
+    stream = ollama_client.chat(
         model='llama3.1',
         messages=[
             {
                 "role": "user",
-                "content": content_json
+                "content": system_prompt + "\nQuestion is: " + question
             }
-        ]
+        ],
+        stream=True
     )
 
-    final_response = message['message']['content']
+    # Hand each piece of the answer on as soon as the model produces it
+    response_parts = []
+    for chunk in stream:
+        text = chunk['message']['content']
+        on_text(text)
+        response_parts.append(text)
+
+    final_response = "".join(response_parts)
     # final_response = next(
     #     (block.text for block in message.content if isinstance(block, TextBlock)),
     #     None,
     # )
     return final_response
 
+def print_text(text):
+    # Print streamed text as soon as it arrives
+    print(text, end="", flush=True)
+
 def main():
     # Create an argument parser
     parser = argparse.ArgumentParser(description="Search for a question in a webpage content")
@@ -101,16 +148,16 @@ def main():
     # Query semantic db
     json_response = query_chunks(args.question)
 
-    rag_response = query_rag(json_response, args.question)
-
     if args.output:
-        # If an output file is specified, write the markdown content to the file
+        # If an output file is specified, write the answer to the file while it is generated
         with open(args.output, 'w', encoding='utf-8') as file:
-            file.write(rag_response)
+            query_rag(json_response, args.question, file.write)
             print(f"Markdown content has been saved to {args.output}")
     else:
-        # Otherwise, print the markdown content to the standard output
-        print(rag_response)
+        # Otherwise, print the answer to the standard output while it is generated
+        query_rag(json_response, args.question, print_text)
+        print()
 
 if __name__ == "__main__":
     main()
+    llm_cache.report()
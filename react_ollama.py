@@ -1,57 +1,104 @@
 import anthropic
 from anthropic.types import TextBlock
-import json
+import functools
+import math
+import re
 import argparse
+import codecs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import html2text
 import ollama
 import chromadb
 from rich.console import Console
 from rich.markdown import Markdown
 
+import llm_cache
+
+# Reuse pooled keep-alive connections for every page fetch
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+# Stop reading a page after this many bytes, so huge pages cannot exhaust memory
+MAX_PAGE_BYTES = 5_000_000
+
 def url_to_markdown(url):
     try:
-        # Send a HTTP request to the URL
-        response = requests.get(url)
+        # Send a HTTP request to the URL, streaming the body instead of buffering it
+        with http_session.get(url, timeout=(5, 30), stream=True) as response:
 
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Convert the HTML content to Markdown
-            html_converter = html2text.HTML2Text()
+            # Check if the request was successful
+            if response.status_code == 200:
+                # Convert the HTML content to Markdown
+                html_converter = html2text.HTML2Text()
 
-            # Optional: Configure the converter
-            html_converter.ignore_links = False
-            html_converter.ignore_images = True
-            html_converter.ignore_emphasis = False
+                # Optional: Configure the converter
+                html_converter.ignore_links = False
+                html_converter.ignore_images = True
+                html_converter.ignore_emphasis = False
+                # Skip the line re-wrapping pass, the text is read by a model, not a terminal
+                html_converter.body_width = 0
 
-            # Convert HTML to Markdown
-            markdown = html_converter.handle(response.text)
+                # Feed the HTML to the converter while it downloads, up to MAX_PAGE_BYTES
+                decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+                received = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    html_converter.feed(decoder.decode(chunk))
+                    received += len(chunk)
+                    if received >= MAX_PAGE_BYTES:
+                        break
 
-            return markdown
-        else:
-            # If the response was not successful, return an error message
-            return f"Error: Received a {response.status_code} status code from the URL."
-    except requests.exceptions.RequestException as e:
+                # Convert HTML to Markdown
+                markdown = html_converter.handle(decoder.decode(b"", final=True))
+
+                return markdown
+            else:
+                # If the response was not successful, return an error message
+                return f"Error: Received a {response.status_code} status code from the URL."
+    except (requests.exceptions.RequestException, LookupError) as e:
         return f"Error: {e}"
 
-def query_chunks(query):
-    if not query:
-        return ""  # Return an empty string if the query is empty
+# Reuse one Ollama client (and its HTTP connection pool) for every call
+ollama_client = ollama.Client()
+# Keep the chat model loaded between turns instead of reloading it after each idle pause
+OLLAMA_KEEP_ALIVE = '10m'
 
-    client = chromadb.HttpClient(host='localhost', port=8000)
-    collection = client.get_collection("docs")
-    # generate an embedding for the prompt and retrieve the most relevant doc
-    response = ollama.embeddings(
-        prompt=query,
-        model="mxbai-embed-large"
-    )
+chroma_client = None
+docs_collection = None
 
-    if not response["embedding"]:
+def get_docs_collection():
+    # Resolve the collection once, every lookup is an HTTP round-trip to Chroma
+    global chroma_client, docs_collection
+    if docs_collection is None:
+        chroma_client = chromadb.HttpClient(host='localhost', port=8000)
+        docs_collection = chroma_client.get_collection("docs")
+
+        # Collections from older versions hold unnormalized vectors without page URLs, which cannot be matched or replaced
+        if (docs_collection.metadata or {}).get("hnsw:space") != "cosine":
+            raise SystemExit("The docs collection was created by an older version of index_site.py. Delete it and index the pages again, see README.md.")
+    return docs_collection
+
+def embed_query(query):
+    # generate an embedding for the prompt, cached on disk for repeated questions
+    return llm_cache.create_embedding(ollama_client, model="mxbai-embed-large", prompt=query)
+
+def find_document(embedding):
+    if not embedding:
         return ""  # Return an empty string if the embedding is empty
 
-    results = collection.query(
-        query_embeddings=[response["embedding"]],
-        n_results=1
+    # retrieve the most relevant doc
+    results = get_docs_collection().query(
+        query_embeddings=[embedding],
+        n_results=1,
+        # Only the document text is used, skip returning metadata and distances
+        include=["documents"]
     )
     print(results)
     if results['documents'] and results['documents'][0]:
@@ -59,13 +106,7 @@ def query_chunks(query):
         return data
     return ""  # Return an empty string if no documents are found
 
-def query_rag(content_chunks, question, conversation_history=[]):
-    client = anthropic.Anthropic(
-        # defaults to os.environ.get("ANTHROPIC_API_KEY")
-    )
-    # Convert the list of content chunks to a JSON string
-    content_chunks_json = json.dumps(content_chunks)
-    system_prompt = """You're a helpful assistant. Please respond to the user's query using the following documents and the React pattern:
+REACT_SYSTEM_PROMPT = """You're a helpful assistant. Please respond to the user's query using the following documents and the React pattern:
 You run in a loop of Thought, Action, PAUSE, Observation.
 At the end of the loop you output an Answer
 Use Thought to describe your thoughts about the question you have been asked.
@@ -90,15 +131,28 @@ Remember to end the response with PAUSE if you entered an Action.
 
 Question is: {}"""
 
-    content_json = json.dumps({
-        "type": "text",
-        "text": system_prompt.format(content_chunks_json, question)
-    })
+# The model ends a turn with PAUSE when it asks for an action to be run
+PAUSE_PATTERN = re.compile(r"\bPAUSE\b")
+# While streaming, PAUSE at the end of the text read so far may still turn out to be a longer word
+STREAM_PAUSE_PATTERN = re.compile(r"\bPAUSE(?=\W)")
+ACTION_PATTERN = re.compile(r"^Action:[ \t]*(?P<action>.+?)[ \t]*\nAction Input:[ \t]*(?P<input>.*?)[ \t]*$", re.MULTILINE)
+
+@functools.lru_cache(maxsize=32)
+def build_system_prompt(content_chunks):
+    # The document from Chroma is already JSON, so it goes into the prompt as is instead of being encoded again.
+    # It stays the same for every question in a session, so the prompt is formatted once
+    return REACT_SYSTEM_PROMPT.format(content_chunks, "")
+
+# Action turns of the current question re-sent to the model, older ones fall out of the window
+MAX_ACTION_TURNS = 5
+
+def query_rag(content_chunks, question, conversation_history=[]):
+    system_prompt = build_system_prompt(content_chunks)
 
     messages = [
         {
             "role": "system",
-            "content": system_prompt.format(content_chunks_json, "")
+            "content": system_prompt
         }
     ] + conversation_history + [
         {
@@ -106,39 +160,88 @@ Question is: {}"""
             "content": question
         }
     ]
+    # The system prompt, the earlier conversation and the question are always kept
+    window_start = len(messages)
 
     while True:
-        message = ollama.chat(
+        stream = ollama_client.chat(
             model='llama3.1',
-            messages=messages
+            messages=messages,
+            keep_alive=OLLAMA_KEEP_ALIVE,
+            stream=True
         )
 
-        response_content = message['message']['content']
-        messages.append({"role": "assistant", "content": response_content})
+        # Print the reply while it is generated, and stop generating once the model asks for an action
+        print("Assistant: ", end="", flush=True)
+        response_parts = []
+        for chunk in stream:
+            text = chunk['message']['content']
+            print(text, end="", flush=True)
+            response_parts.append(text)
+            if STREAM_PAUSE_PATTERN.search("".join(response_parts[-4:])):
+                stream.close()
+                break
+        print()
 
-        print("Assistant:", response_content)
+        response_content = "".join(response_parts)
+        messages.append({"role": "assistant", "content": response_content})
 
-        if "PAUSE" in response_content:
+        if PAUSE_PATTERN.search(response_content):
+            action = ACTION_PATTERN.search(response_content)
+            if action:
+                print(f"Requested action: {action.group('action')}({action.group('input')})")
             user_input = input("Simulated response: ")
             messages.append({"role": "user", "content": user_input})
+            del messages[window_start:-2 * MAX_ACTION_TURNS]
             print(messages)
         else:
             break
 
     return response_content
 
-def interactive_shell(json_response):
+# Keep the conversation sent back to the model bounded, as it is re-sent in full every turn
+MAX_HISTORY_MESSAGES = 40
+MAX_HISTORY_CHARS = 24000
+
+EXIT_COMMANDS = frozenset(['exit', 'quit', 'bye'])
+
+def trim_history(conversation_history):
+    # Drop the oldest question/answer pairs until the history fits both limits
+    total_chars = sum(len(message["content"]) for message in conversation_history)
+    while conversation_history and (
+        len(conversation_history) > MAX_HISTORY_MESSAGES or total_chars > MAX_HISTORY_CHARS
+    ):
+        for message in conversation_history[:2]:
+            total_chars -= len(message["content"])
+        del conversation_history[:2]
+
+# Follow-up questions at least this similar to the last fetched question keep its documents
+REFETCH_SIMILARITY = 0.8
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    return dot / (math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b)))
+
+def interactive_shell(json_response, last_embedding=None):
+    # last_embedding is the embedding of the question json_response was fetched for
     conversation_history = []
     while True:
         question = input("You: ")
-        if question.lower() in ['exit', 'quit', 'bye']:
+        if question.lower() in EXIT_COMMANDS:
             break
 
+        # Fetch the documents again only when the question moves to a different topic
+        embedding = embed_query(question) if question.strip() else None
+        if embedding and (last_embedding is None or cosine_similarity(embedding, last_embedding) < REFETCH_SIMILARITY):
+            json_response = find_document(embedding)
+            last_embedding = embedding
+
         rag_response = query_rag(json_response, question, conversation_history)
         print("Assistant:", rag_response)
 
         conversation_history.append({"role": "user", "content": question})
         conversation_history.append({"role": "assistant", "content": rag_response})
+        trim_history(conversation_history)
 
 def main():
     # Create an argument parser
@@ -150,12 +253,19 @@ def main():
     # Parse command-line arguments
     args = parser.parse_args()
 
-    # Query semantic db
-    json_response = query_chunks(args.question if args.question else "")
+    # Query semantic db, an empty question finds no documents
+    embedding = embed_query(args.question) if args.question and args.question.strip() else None
+    json_response = find_document(embedding)
 
     if args.interactive:
-        interactive_shell(json_response)
+        # The shell keeps these documents for follow-up questions on the same topic
+        interactive_shell(json_response, embedding)
     elif args.question:
+        if not json_response:
+            # Without any documents there is nothing for the model to answer from
+            print("No matching documents.")
+            return
+
         rag_response = query_rag(json_response, args.question)
 
         if args.output:
@@ -171,3 +281,4 @@ def main():
 
 if __name__ == "__main__":
     main()
+    llm_cache.report()